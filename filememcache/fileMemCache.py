@@ -42,6 +42,10 @@ import re
 import os
 import shutil
 import glob
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 def to_unicode(obj, encoding='utf-8'):
     if not isinstance(obj, str):
@@ -49,6 +53,14 @@ def to_unicode(obj, encoding='utf-8'):
     return obj
 
 DEFAULT_EXPIRY = 60*60
+DEFAULT_NEGATIVE_EXPIRY = 60
+DEFAULT_PURGE_BATCH = 1000
+DEFAULT_PURGE_WORKERS = 16
+DEFAULT_TMP_EXPIRY = 60*60
+DEFAULT_GC_INTERVAL = 60*60
+DEFAULT_GC_PAUSE = 0.01
+DEFAULT_GC_LOW_WATER = 0.9
+DEFAULT_ATIME_RESOLUTION = 60*60
 
 class RedisConnect(object):
     """
@@ -110,6 +122,188 @@ class DoNotCache(Exception):
         return self._result
 
 
+class CachedException(object):
+    """
+    Wraps an exception stored by cache_it(cache_exceptions=...), it is re-raised on a cache hit.
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class CachedEmpty(object):
+    """
+    Wraps a result stored by cache_it(empty_result=...), it is unwrapped on a cache hit.
+    """
+    def __init__(self, result):
+        self.result = result
+
+
+def is_empty(result):
+    # default check for cache_it(empty_result=is_empty) : None or anything with len() == 0
+    if result is None:
+        return True
+    try:
+        return len(result) == 0
+    except TypeError:
+        return False
+
+
+class CacheTracer(object):
+    """
+    Base class for tracing hooks, subclasses override record() and/or record_call().
+    The timed phases of a sampled cache_it call are:
+        bind         - inspect.signature binding of the arguments
+        hash         - get_hash, including the funcDef bookkeeping
+        redis_get    - redis GET of the cache key
+        unpickle     - decode and unpickle of the redis value
+        file_read    - atomicread of the file cache
+        call         - the wrapped function itself (cache miss)
+        store_memory - store_key into redis
+        store_file   - atomicwrite into the file cache
+        total        - the whole cache_it call
+    Exceptions raised by a tracer are turned into warnings, they never reach the cached call.
+    """
+    def record(self, func_name, phase, start, duration):
+        # start    - wall clock time.time() at the beginning of the phase
+        # duration - seconds spent in the phase
+        pass
+
+    def record_call(self, func_name, spans):
+        # called once per sampled cache_it call when it finishes
+        # spans - [(phase, start, duration)] in the order the phases finished, total is last
+        for phase, start, duration in spans:
+            self.record(func_name, phase, start, duration)
+
+
+class ProfileTracer(CacheTracer):
+    """
+    Aggregates count, total and max time per function and phase.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, func_name, phase, start, duration):
+        with self._lock:
+            stat = self._stats.setdefault((func_name, phase), [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def report(self, func='', show=True):
+        # func - only report functions starting with func
+
+        with self._lock:
+            stats = sorted(self._stats.items())
+
+        rows = []
+        for (func_name, phase), (count, total, max_) in stats:
+            if not func_name.startswith(func):
+                continue
+            rows.append({'func': func_name, 'phase': phase, 'count': count, 'total': total,
+                         'mean': total / count, 'max': max_})
+
+        if show:
+            for r in rows:
+                print(f"{r['func']} | {r['phase']:<12} | count {r['count']:>8} | total {r['total'] * 1000:>10.2f} ms"
+                      f" | mean {r['mean'] * 1000:>8.3f} ms | max {r['max'] * 1000:>8.3f} ms")
+        else:
+            return rows
+
+
+class OpenTelemetryTracer(CacheTracer):
+    """
+    Emits a cache_it call as an OpenTelemetry span filememcache.total, in the active context,
+    with a child span filememcache.<phase> for every phase.
+    Needs the opentelemetry-api package and a configured tracer provider.
+    """
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError('OpenTelemetryTracer needs the opentelemetry-api package')
+        self._trace = trace
+        self.tracer = tracer if tracer is not None else trace.get_tracer('filememcache')
+
+    def _emit(self, func_name, phase, start, duration, context=None):
+        start_ns = int(start * 1e9)
+        span = self.tracer.start_span(f'filememcache.{phase}', context=context, start_time=start_ns,
+                                      attributes={'cache.function': func_name, 'cache.phase': phase})
+        span.end(end_time=start_ns + int(duration * 1e9))
+        return span
+
+    def record(self, func_name, phase, start, duration):
+        self._emit(func_name, phase, start, duration)
+
+    def record_call(self, func_name, spans):
+        if not spans or spans[-1][0] != 'total':
+            return super(OpenTelemetryTracer, self).record_call(func_name, spans)
+
+        phase, start, duration = spans[-1]
+        start_ns = int(start * 1e9)
+        parent = self.tracer.start_span('filememcache.total', start_time=start_ns,
+                                        attributes={'cache.function': func_name, 'cache.phase': phase})
+        context = self._trace.set_span_in_context(parent)
+        for phase, child_start, child_duration in spans[:-1]:
+            self._emit(func_name, phase, child_start, child_duration, context)
+        parent.end(end_time=start_ns + int(duration * 1e9))
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Span(object):
+    def __init__(self, call_trace, phase):
+        self.call_trace = call_trace
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.call_trace.add(self.phase, self.start, time.perf_counter() - self.t0)
+        return False
+
+
+class CallTrace(object):
+    # phases of a single cache_it call, sent to tracer when the total phase ends
+    _no_span = _NoSpan()
+
+    def __init__(self, tracer=None, func_name=''):
+        self.tracer = tracer
+        self.func_name = func_name
+        self.spans = []
+
+    def span(self, phase):
+        if self.tracer is None:
+            return self._no_span
+        return _Span(self, phase)
+
+    def add(self, phase, start, duration):
+        self.spans.append((phase, start, duration))
+        if phase == 'total':
+            spans, self.spans = self.spans, []
+            try:
+                self.tracer.record_call(self.func_name, spans)
+            except Exception as e:
+                # tracing must never break the cached call
+                warnings.warn(f'Cache tracer failed : {e!r}')
+
+
+NO_TRACE = CallTrace()
+
+
 class FileMemCache(object):
     def __init__(self,
                  limit=10000,
@@ -123,12 +317,25 @@ class FileMemCache(object):
                  password=None,
                  namespace="cache1",
                  decode_responses=True,
-                 encoding='iso-8859-1'):
+                 encoding='iso-8859-1',
+                 fanout=0,
+                 fanout_width=2,
+                 tracer=None,
+                 trace_sample_rate=1.0,
+                 disk_budget=None,
+                 file_expire=None):
         # filecache     - is directory location for saving data in file cache.
         # expire        - Time to keys to expire in seconds. Files in filecache never expire
         # limit         - No of json encoded strings to cache. So such limit on file cache
         # donotfilecahe - as the name suggests this can be used with certain function that do not need to be cached in file
         # donotmemcache  - disable redis cache
+        # fanout        - no of hex prefix directory levels a parameter hash is spread over in the file cache
+        #                 e.g. fanout=2 stores namespace/ab/cd/P<rest of hash>, 0 keeps the flat namespace/P<hash> layout
+        # fanout_width  - no of hex characters in each fanout directory name
+        # tracer        - CacheTracer receiving timed phases of cache_it calls e.g. ProfileTracer()
+        # trace_sample_rate - fraction of cache_it calls traced
+        # disk_budget   - max bytes of the namespace file cache, enforced by collect_files / start_collector
+        # file_expire   - max age in seconds of cached files, or {funcname : seconds}, enforced by collect_files
 
         self.limit = limit
         self.expire = expire
@@ -139,6 +346,19 @@ class FileMemCache(object):
         self.filecache = filecache
         self.donotmemcache = donotmemcache
         self.db = db
+        self.fanout = fanout
+        self.fanout_width = fanout_width
+        self.tracer = tracer
+        self.trace_sample_rate = trace_sample_rate
+        self.disk_budget = disk_budget
+        self.file_expire = file_expire
+        self._collector = None
+
+        if fanout < 0 or fanout_width < 1 or fanout * fanout_width >= 128:
+            raise ValueError('fanout * fanout_width must be less than the 128 characters of the parameter hash')
+
+        # directories known to exist, saves a stat per read/write. Entries are dropped when we delete a directory
+        self._known_dirs = set()
 
         if (not self.filecache) and (not self.donotfilecahe ):
             warnings.warn('Parameter filecahe is empty. Disabling file cache')
@@ -211,22 +431,113 @@ class FileMemCache(object):
         self.store(key, pickle.dumps(value), expire)
 
     def store_key_file(self, key, value):
-        full_file_name, file_dir, date_file = self.key_to_file(key)
+        full_file_name, file_dir, date_file = self.key_to_file(key, create=True)
 
         self.atomicwrite( file_dir, date_file, value)
 
-    def key_to_file(self,key):
+        # the funcDef file is only written alongside a data file, so parameter sets that only ever
+        # cache failures or empty results in memory leave nothing in the file cache. Another process
+        # (clear_files, collect_files) may also have removed it, so check on every write
+        namespace, func, hash_str = key.split(':')[:3]
+        funcDef_file = os.path.join(self.filecache, namespace, 'funcDefDir', 'P' + hash_str + '.txt')
+        if not os.path.exists(funcDef_file) and self.connection is not None:
+            funcDef = self.connection.get(f'{namespace}:{func}:{hash_str}:funcDef')
+            if funcDef:
+                self._known_dirs.discard(os.path.dirname(funcDef_file))
+                self.write_funcDef(hash_str, funcDef)
 
-        namespace_dir, func, func_dir, date_file = key.split(':')
+    def key_to_file(self, key, create=False):
+        # create - make the parameter directory if missing, only needed when writing
+
+        namespace_dir, func, hash_str, date_file = key.split(':')
 
-        func_dir = 'P' + func_dir
         date_file = date_file + '.pkl'
-        file_dir = os.path.join(self.filecache, namespace_dir, func_dir)
-        self.makeDirIfNotExist(file_dir)
+        file_dir = self.hash_to_dir(hash_str, namespace_dir)
+        if create:
+            self.makeDirIfNotExist(file_dir)
         full_file_name = os.path.join(file_dir, date_file)
 
         return full_file_name, file_dir, date_file
 
+    def hash_to_dir(self, hash_str, namespace=None, fanout=None, fanout_width=None):
+        # parameter hash -> directory holding its date files
+        # with fanout=2, fanout_width=2 hash abcdef... is stored in namespace/ab/cd/Pef...
+
+        namespace = namespace if namespace else self.namespace
+        fanout = self.fanout if fanout is None else fanout
+        fanout_width = self.fanout_width if fanout_width is None else fanout_width
+
+        prefix = [hash_str[i * fanout_width:(i + 1) * fanout_width] for i in range(fanout)]
+        leaf = 'P' + hash_str[fanout * fanout_width:]
+
+        return os.path.join(self.filecache, namespace, *prefix, leaf)
+
+    def dir_to_hash(self, file_dir, fanout=None):
+        # inverse of hash_to_dir
+
+        fanout = self.fanout if fanout is None else fanout
+
+        parts = os.path.normpath(file_dir).split(os.sep)
+        prefix = parts[len(parts) - 1 - fanout:-1]
+
+        return ''.join(prefix) + parts[-1][1:]
+
+    def list_param_dirs(self, fanout=None, fanout_width=None):
+        # all P<hash> directories of the namespace for the given layout
+
+        fanout = self.fanout if fanout is None else fanout
+        fanout_width = self.fanout_width if fanout_width is None else fanout_width
+
+        prefix = ['[0-9a-f]' * fanout_width] * fanout
+        return glob.glob(os.path.join(self.filecache, self.namespace, *prefix, 'P*'))
+
+    def migrate_files(self, from_fanout=0, from_fanout_width=2, show=True):
+        # Move a file cache written with another fanout layout into the current one
+        # e.g. cache = FileMemCache(namespace="pycache1", filecache=r'z:\cache', fanout=2)
+        #      cache.migrate_files(from_fanout=0)
+
+        if self.donotfilecahe:
+            print('File cache is disabled')
+            return 0
+
+        if (from_fanout, from_fanout_width) == (self.fanout, self.fanout_width):
+            print('File cache already uses this layout. Nothing to migrate')
+            return 0
+
+        cache_dir = os.path.join(self.filecache, self.namespace)
+        count = 0
+        for old_dir in self.list_param_dirs(from_fanout, from_fanout_width):
+            hash_str = self.dir_to_hash(old_dir, from_fanout)
+            new_dir = self.hash_to_dir(hash_str)
+            if os.path.normpath(old_dir) == os.path.normpath(new_dir):
+                continue
+
+            if not os.path.isdir(new_dir):
+                self.makeDirIfNotExist(os.path.dirname(new_dir))
+                os.rename(old_dir, new_dir)
+            else:
+                # a process already wrote into the new layout, merge file by file
+                for f in os.listdir(old_dir):
+                    os.replace(os.path.join(old_dir, f), os.path.join(new_dir, f))
+                os.rmdir(old_dir)
+            self._known_dirs.add(new_dir)
+            count += 1
+
+            # drop emptied fanout directories of the old layout
+            parent = os.path.dirname(old_dir)
+            while os.path.normpath(parent) != os.path.normpath(cache_dir) and len(os.listdir(parent)) == 0:
+                os.rmdir(parent)
+                self._known_dirs.discard(parent)
+                parent = os.path.dirname(parent)
+
+            if show:
+                print(f'Moved : {old_dir} -> {new_dir}')
+
+        if show:
+            print(f"Total : {count} directories migrated")
+
+        return count
+
     def atomicwrite(self, destination, filename, data):
 
         file_path = os.path.join(destination, filename)
@@ -242,7 +553,15 @@ class FileMemCache(object):
             temp_file_path = file_path + f'{pid}.tmp'
 
             # Write the pickled object to the temporary file
-            with open(temp_file_path, 'wb') as temp_file:
+            try:
+                temp_file = open(temp_file_path, 'wb')
+            except FileNotFoundError:
+                # directory was removed by another process since we cached it
+                self._known_dirs.discard(destination)
+                self.makeDirIfNotExist(destination)
+                temp_file = open(temp_file_path, 'wb')
+
+            with temp_file:
                 pickle.dump(save_data, temp_file)
 
             # Perform atomic write by renaming the temporary file to the final destination
@@ -271,21 +590,38 @@ class FileMemCache(object):
 
 
 
-    def get(self, key, encoding='iso-8859-1'):
+    def get(self, key, encoding='iso-8859-1', trace=NO_TRACE):
 
         key = to_unicode(key)
         if key:  # No need to validate membership, which is an O(1) operation, but seems we can do without.
-            value = self.connection.get(key)
+            with trace.span('redis_get'):
+                value = self.connection.get(key)
             if value is None:  # expired key
                 # check load it from file cache
                 if not self.donotfilecahe:
                     file_name = self.key_to_file(key)[0]
                     if os.path.exists(file_name):
-                        value = self.atomicread(file_name)
-                        # save the file in memory
-                        self.store_key(key,value)
-                        # return the value
-                        return value
+                        try:
+                            with trace.span('file_read'):
+                                value = self.atomicread(file_name)
+                        except OSError:
+                            # removed by clear_files or collect_files since the exists check, carry on as a miss
+                            pass
+                        else:
+                            # mark as recently used for collect_files, atime only so mtime keeps the age of the data.
+                            # At most once per DEFAULT_ATIME_RESOLUTION to spare a metadata write on most reads
+                            try:
+                                st = os.stat(file_name)
+                                now = time.time()
+                                if now - st.st_atime > DEFAULT_ATIME_RESOLUTION:
+                                    os.utime(file_name, (now, st.st_mtime))
+                            except OSError:
+                                pass
+                            # save the file in memory
+                            with trace.span('store_memory'):
+                                self.store_key(key,value)
+                            # return the value
+                            return value
 
                 if not key in self:  # If key does not exist at all, it is a straight miss.
                     raise CacheMissException
@@ -293,20 +629,32 @@ class FileMemCache(object):
                 self.connection.srem(self.get_set_name(key), key)
                 raise ExpiredKeyException
             else:
-                value = pickle.loads(value.encode(encoding))
+                try:
+                    with trace.span('unpickle'):
+                        value = pickle.loads(value.encode(encoding))
+                except Exception:
+                    # a value that cannot be unpickled is as good as missing
+                    self.connection.delete(key)
+                    raise CacheMissException
+                # failures and empty results are never written to the file cache
+                if isinstance(value, (CachedException, CachedEmpty)):
+                    return value
                 # before returning value make sure the key in there in the file cache
                 if not self.donotfilecahe:
                     file_name = self.key_to_file(key)[0]
-                    if os.path.exists(file_name):
-                        self.store_key_file(key, value)
+                    if not os.path.exists(file_name):
+                        with trace.span('store_file'):
+                            self.store_key_file(key, value)
                 return value
 
 
 
 
     def makeDirIfNotExist(self,dirName):
-        if not os.path.isdir(dirName):
-            os.makedirs(dirName)
+        if dirName in self._known_dirs:
+            return
+        os.makedirs(dirName, exist_ok=True)
+        self._known_dirs.add(dirName)
 
     def read_funcDef(self):
         cache_dir = os.path.join(self.filecache, self.namespace)
@@ -381,6 +729,15 @@ class FileMemCache(object):
 
 
 
+    def write_funcDef(self, hash_str, funcDef):
+        funcDef_dir = os.path.join(self.filecache, self.namespace,'funcDefDir')
+        self.makeDirIfNotExist(funcDef_dir)
+        funcDef_file = os.path.join(funcDef_dir, 'P' + hash_str + '.txt')
+        if not os.path.exists(funcDef_file):
+            with open(funcDef_file,'w') as f:
+                f.write(funcDef)
+            f.close()
+
     def get_hash(self,  funcname, bound_arguments):
 
         # the keys are stored as namespace:funcname:parameters hexcode:dateStr
@@ -406,33 +763,35 @@ class FileMemCache(object):
             pipe.sadd(f'{self.namespace}:funcDef', funcDefKey)
             pipe.execute()
 
-        if self.filecache:
-            funcDef_dir = os.path.join(self.filecache, self.namespace,'funcDefDir')
-            self.makeDirIfNotExist(funcDef_dir)
-            funcDef_file = os.path.join(funcDef_dir, 'P' + key + '.txt')
-            if not os.path.exists(funcDef_file):
-                with open(funcDef_file,'w') as f:
-                    f.write(funcDef)
-                f.close()
 
         cache_key = f'{self.namespace}:{funcname}:{key}:{date_str}'
 
         return cache_key
 
-    def clear_memory(self, func , param_str,start_str, end_str, hash_str, show = True):
-
-
-        if self.donotmemcache:
-            print('Mem cache is disabled')
-            return
+    def scan_funcDefs(self, batch_size=DEFAULT_PURGE_BATCH):
+        # same 'namespace:func:hash | funcDef' entries as list_memory, using SCAN and pipelined GETs
+        # instead of KEYS and a TYPE per key, so redis is not blocked
+        funcDef_list = []
+        funcDef_keys = list(self.connection.scan_iter(match=f"{self.namespace}:*:funcDef", count=batch_size))
+        for i in range(0, len(funcDef_keys), batch_size):
+            batch = funcDef_keys[i:i + batch_size]
+            pipe = self.connection.pipeline(transaction=False)
+            for k in batch:
+                pipe.get(k)
+            for k, txt in zip(batch, pipe.execute()):
+                if txt:
+                    funcDef_list.append(k[:-len(':funcDef')] + ' | ' + txt)
+        return funcDef_list
 
+    def plan_memory(self, func, param_str, start_str, end_str, hash_str, batch_size=DEFAULT_PURGE_BATCH):
+        # returns the redis keys clear_memory would delete
 
         if param_str:
             # this is a special case where the keys in list keys are further pared
             # down by likeness to function parameters to param_str e.g. we may want to delete getSf1 function which has
             # parameter 'pe' in the parameter dictionary.
 
-            memory_list = self.list_memory(show=False)
+            memory_list = self.scan_funcDefs(batch_size)
             param_filter_list = []
             for m in memory_list:
                 if param_str in m:
@@ -451,8 +810,9 @@ class FileMemCache(object):
         if start_str or end_str:
             # exact match for start_date when end_date is not applicable
             if start_str and not end_str:
-                search_str = search_str + 'start_str'
+                search_str = search_str + start_str
 
+        # SCAN instead of KEYS so redis is not blocked walking the whole keyspace in one go
         all_keys = []
         param_str_new = []
         if param_str:
@@ -465,10 +825,10 @@ class FileMemCache(object):
 
             for p in param_str_new:
                 p = p + '*'
-                all_keys = all_keys + self.connection.keys(p)
+                all_keys = all_keys + list(self.connection.scan_iter(match=p, count=batch_size))
 
         else:
-            all_keys = self.connection.keys(search_str)
+            all_keys = list(self.connection.scan_iter(match=search_str, count=batch_size))
 
         keys = []
         # case when start and end date is supplied
@@ -483,26 +843,44 @@ class FileMemCache(object):
         else:
             keys = all_keys
 
+        return keys
+
+    def clear_memory(self, func , param_str,start_str, end_str, hash_str, show = True, dry_run=False,
+                     batch_size=DEFAULT_PURGE_BATCH, progress=None):
+        # dry_run    - only return the keys that would be deleted
+        # batch_size - no of keys per UNLINK, keeps redis responsive on large purges
+        # progress   - callable(tier, done, total) called after every batch
+
+        if self.donotmemcache:
+            print('Mem cache is disabled')
+            return []
+
+        keys = self.plan_memory(func, param_str, start_str, end_str, hash_str, batch_size)
 
+        if dry_run:
+            if show:
+                print(f"Total : {len(keys)} keys would be deleted from MEMORY")
+            return keys
 
         if len(keys) > 0:
-            with self.connection.pipeline() as pipe:
-                pipe.delete(*keys)
-                pipe.execute()
+            done = 0
+            for i in range(0, len(keys), batch_size):
+                batch = keys[i:i + batch_size]
+                # UNLINK frees the values in a background thread on the redis server
+                self.connection.unlink(*batch)
+                done += len(batch)
+                if progress:
+                    progress('memory', done, len(keys))
 
             if show:
-                for i in keys:
-                    print(f'Deleted : {i}')
                 print(f"Total : {len(keys)} keys deleted from MEMORY")
-        else:
+        elif show:
             print('No key with matching fingerprint found in MEMORY. No key was deleted')
 
-    def clear_files(self, func, param_str, start_str, end_str, hash_str, show=True):
-
+        return keys
 
-        if self.donotfilecahe:
-            print('File cache is disabled')
-            return
+    def plan_files(self, func, param_str, start_str, end_str, hash_str):
+        # returns {param directory : [files to delete]} for clear_files
 
         if param_str:
             # this is a special case where the keys in list keys are further pared
@@ -530,20 +908,24 @@ class FileMemCache(object):
         all_keys = []
         if param_str:
             for p in param_filter_list:
-                all_keys.append(os.path.join(cache_dir, 'P' + p))
+                all_keys.append(self.hash_to_dir(p))
         else:
-            all_keys = glob.glob(os.path.join(cache_dir, 'P*'))
+            all_keys = self.list_param_dirs()
 
-        count = 0
+        plan = {}
         for file_dir in all_keys:
             all_files = glob.glob(os.path.join(file_dir, '*.pkl'))
-            key_dir = os.path.split(file_dir)[1]
-            funcDefFile = os.path.join(funcDefDir, key_dir + '.txt')
+            key_hash = self.dir_to_hash(file_dir)
+            funcDefFile = os.path.join(funcDefDir, 'P' + key_hash + '.txt')
 
             if func:
-                with open(funcDefFile, 'r') as f:
-                    txt = f.read()
-                f.close()
+                try:
+                    with open(funcDefFile, 'r') as f:
+                        txt = f.read()
+                    f.close()
+                except FileNotFoundError:
+                    # funcDef removed by another process, the function cannot be matched
+                    continue
 
                 extracted_func = re.findall(r'(.*)({.*})', txt)[0][0]
 
@@ -552,40 +934,88 @@ class FileMemCache(object):
                     continue
 
             if hash_str:
-                if key_dir[1:] != hash_str:
+                if key_hash != hash_str:
                     # skip this iteration
                     continue
 
+            plan[file_dir] = []
             for f in all_files:
                 dateStr = os.path.split(f)[1].replace('.pkl', '')
                 if (start_str <= dateStr) & (dateStr <= end_str):
-                    full_file_name = os.path.join(file_dir, f)
-                    try:
-                        os.remove(full_file_name)
-                        if show:
-                            print(f'Deleted : {full_file_name}')
-                        count += 1
-                    except FileNotFoundError:
-                        pass
-                    except:
-                        print(f"Cannot delete {full_file_name}")
+                    plan[file_dir].append(f)
+
+        return plan
+
+    def _remove_file(self, full_file_name):
+        try:
+            os.remove(full_file_name)
+            return True
+        except FileNotFoundError:
+            return False
+        except:
+            print(f"Cannot delete {full_file_name}")
+            return False
+
+    def clear_files(self, func, param_str, start_str, end_str, hash_str, show=True, dry_run=False,
+                    workers=DEFAULT_PURGE_WORKERS, batch_size=DEFAULT_PURGE_BATCH, progress=None):
+        # dry_run    - only return the files that would be deleted
+        # workers    - no of threads deleting files, network shares are latency and not throughput bound
+        # batch_size - progress is reported every batch_size files
+        # progress   - callable(tier, done, total)
+
+        if self.donotfilecahe:
+            print('File cache is disabled')
+            return []
+
+        plan = self.plan_files(func, param_str, start_str, end_str, hash_str)
+        files = [f for file_dir in plan for f in plan[file_dir]]
 
+        if dry_run:
+            if show:
+                print(f"Total : {len(files)} FILES would be deleted")
+            return files
+
+        count = 0
+        done = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # submit a batch at a time, map() would create a future for every file up front
+            for i in range(0, len(files), batch_size):
+                batch = files[i:i + batch_size]
+                count += sum(executor.map(self._remove_file, batch))
+                done += len(batch)
+                if progress:
+                    progress('files', done, len(files))
+
+        funcDefDir = os.path.join(self.filecache, self.namespace, 'funcDefDir')
+        for file_dir in plan:
             # check if the directory is empty
-            if len(os.listdir(file_dir)) == 0:
+            if os.path.isdir(file_dir) and len(os.listdir(file_dir)) == 0:
+                key_hash = self.dir_to_hash(file_dir)
                 shutil.rmtree(file_dir)
-                os.remove(funcDefFile)
+                self._known_dirs.discard(file_dir)
+                funcDefFile = os.path.join(funcDefDir, 'P' + key_hash + '.txt')
+                if os.path.exists(funcDefFile):
+                    os.remove(funcDefFile)
 
-            if show:
-                print(f"Total : {count} FILES deleted")
+        if show:
+            print(f"Total : {count} FILES deleted")
+
+        return files
 
 
-    def clear(self, func = None, param_str = None,start_date= None, end_date = None, hash_str = None, show = True, memory=True, file=True):
+    def clear(self, func = None, param_str = None,start_date= None, end_date = None, hash_str = None, show = True, memory=True, file=True,
+              dry_run=False, workers=DEFAULT_PURGE_WORKERS, batch_size=DEFAULT_PURGE_BATCH, progress=None):
         # func       - delete all enteries related to funcname, func* to delete all the functions starting with func
         # start_date - delete all enteries for start_date (just for funcname if supplied) this could be datetime object or YYYYMMDD_HHMM formatted string
         # end_date   - delete all enteries between start_date and end_date ( just for funcname if supplied) this could be datetime object or YYYYMMDD_HHMM formatted string
         # hash_str   - delete all enteries matching hash_str, and any of the above applicable conditions
         # memory     - clear in memory cached data
         # file       - clear cached files data
+        # dry_run    - do not delete anything, just return the plan
+        # workers    - no of threads used to delete files
+        # batch_size - no of redis keys per UNLINK and no of files between progress calls
+        # progress   - callable(tier, done, total) with tier 'memory' or 'files'
+        # returns {'memory' : [keys], 'files' : [file names]} deleted, or to be deleted for a dry_run
 
         if not start_date and end_date:
             raise ValueError('End date without a start date in cache.clear')
@@ -606,21 +1036,229 @@ class FileMemCache(object):
         else:
             end_str = ''
 
+        result = {'memory': [], 'files': []}
 
         if memory:
-            self.clear_memory( func, param_str, start_str, end_str, hash_str, show)
+            result['memory'] = self.clear_memory( func, param_str, start_str, end_str, hash_str, show,
+                                                  dry_run=dry_run, batch_size=batch_size, progress=progress)
 
 
         if file:
-            self.clear_files( func, param_str, start_str, end_str, hash_str, show)
+            result['files'] = self.clear_files( func, param_str, start_str, end_str, hash_str, show,
+                                                dry_run=dry_run, workers=workers, batch_size=batch_size,
+                                                progress=progress)
+
+        return result
+
+
+
+    def _func_of_dir(self, key_hash, funcs):
+        # function name of a parameter directory from its funcDef file, cached in funcs
+        if key_hash not in funcs:
+            funcDefFile = os.path.join(self.filecache, self.namespace, 'funcDefDir', 'P' + key_hash + '.txt')
+            try:
+                with open(funcDefFile, 'r') as f:
+                    txt = f.read()
+                funcs[key_hash] = re.findall(r'(.*)({.*})', txt)[0][0]
+            except (OSError, IndexError):
+                funcs[key_hash] = None
+        return funcs[key_hash]
+
+    def _remove_param_dir(self, file_dir):
+        # remove an empty parameter directory and its funcDef, False if a writer got there first
+        try:
+            os.rmdir(file_dir)
+        except OSError:
+            return False
+        self._known_dirs.discard(file_dir)
+
+        key_hash = self.dir_to_hash(file_dir)
+        funcDefFile = os.path.join(self.filecache, self.namespace, 'funcDefDir', 'P' + key_hash + '.txt')
+        if os.path.exists(funcDefFile):
+            self._remove_file(funcDefFile)
+        return True
+
+    def collect_files(self, disk_budget=None, file_expire=None, tmp_expire=DEFAULT_TMP_EXPIRY,
+                      batch_size=DEFAULT_PURGE_BATCH, pause=DEFAULT_GC_PAUSE, show=True):
+        # Garbage collect the file cache of the namespace
+        # disk_budget - max bytes of cached files, least recently read (atime) files are evicted down to
+        #               DEFAULT_GC_LOW_WATER of the budget. Defaults to the one given to the constructor
+        # file_expire - max age in seconds since a file was written (mtime), or {funcname : seconds}.
+        #               Defaults to the constructor's
+        # tmp_expire  - age in seconds after which <pid>.tmp files left by crashed writes, and funcDef files
+        #               without a parameter directory, are removed
+        # batch_size  - no of files looked at or deleted before sleeping pause seconds, so readers are not starved
+        # returns {'files' : n, 'tmp' : n, 'funcDefs' : n, 'dirs' : n, 'bytes' : n} removed
+
+        if self.donotfilecahe:
+            print('File cache is disabled')
+            return {'files': 0, 'tmp': 0, 'funcDefs': 0, 'dirs': 0, 'bytes': 0}
 
+        disk_budget = self.disk_budget if disk_budget is None else disk_budget
+        file_expire = self.file_expire if file_expire is None else file_expire
 
+        stats = {'files': 0, 'tmp': 0, 'funcDefs': 0, 'dirs': 0, 'bytes': 0}
+        funcs = {}
+        inventory = []
+        total = 0
+        seen = 0
+        now = time.time()
 
-    def cache_it(self, expire= None):
+        for file_dir in self.list_param_dirs():
+            max_age = file_expire
+            if isinstance(file_expire, dict):
+                max_age = file_expire.get(self._func_of_dir(self.dir_to_hash(file_dir), funcs))
+
+            try:
+                entries = list(os.scandir(file_dir))
+            except FileNotFoundError:
+                continue
+
+            for entry in entries:
+                seen += 1
+                if seen % batch_size == 0:
+                    time.sleep(pause)
+
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                if entry.name.endswith('.tmp'):
+                    if now - st.st_mtime > tmp_expire and self._remove_file(entry.path):
+                        stats['tmp'] += 1
+                        stats['bytes'] += st.st_size
+                    continue
+
+                if not entry.name.endswith('.pkl'):
+                    continue
+
+                # age is from mtime, last write. atime is set by get() on file cache reads
+                accessed = max(st.st_atime, st.st_mtime)
+                if max_age is not None and now - st.st_mtime > max_age:
+                    if self._remove_file(entry.path):
+                        stats['files'] += 1
+                        stats['bytes'] += st.st_size
+                    continue
+
+                inventory.append((accessed, st.st_size, entry.path))
+                total += st.st_size
+
+        if disk_budget is not None and total > disk_budget:
+            target = disk_budget * DEFAULT_GC_LOW_WATER
+            inventory.sort()
+            for accessed, size, path in inventory:
+                if total <= target:
+                    break
+                if self._remove_file(path):
+                    stats['files'] += 1
+                    stats['bytes'] += size
+                    total -= size
+                    if stats['files'] % batch_size == 0:
+                        time.sleep(pause)
+
+        # sweep emptied parameter directories, then emptied fanout directories from the bottom up
+        for file_dir in self.list_param_dirs():
+            try:
+                empty = len(os.listdir(file_dir)) == 0
+            except FileNotFoundError:
+                # removed by a concurrent clear_files, collector or migrate_files
+                continue
+            if empty and self._remove_param_dir(file_dir):
+                stats['dirs'] += 1
+
+        cache_dir = os.path.join(self.filecache, self.namespace)
+        for level in range(self.fanout, 0, -1):
+            for prefix_dir in glob.glob(os.path.join(cache_dir, *['[0-9a-f]' * self.fanout_width] * level)):
+                try:
+                    os.rmdir(prefix_dir)
+                except OSError:
+                    continue
+                self._known_dirs.discard(prefix_dir)
+                stats['dirs'] += 1
+
+        # funcDef files without a parameter directory, left by processes whose directory was removed elsewhere.
+        # Only old ones, a writer writes its data file before the funcDef
+        param_hashes = set(self.dir_to_hash(file_dir) for file_dir in self.list_param_dirs())
+        try:
+            funcDef_entries = list(os.scandir(os.path.join(cache_dir, 'funcDefDir')))
+        except FileNotFoundError:
+            funcDef_entries = []
+        for entry in funcDef_entries:
+            key_hash = entry.name[1:-len('.txt')]
+            if key_hash in param_hashes:
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - st.st_mtime > tmp_expire and not os.path.isdir(self.hash_to_dir(key_hash)):
+                if self._remove_file(entry.path):
+                    stats['funcDefs'] += 1
+                    stats['bytes'] += st.st_size
+
+        if show:
+            print(f"Total : {stats['files']} FILES, {stats['tmp']} tmp files, {stats['funcDefs']} funcDef files"
+                  f" and {stats['dirs']} directories removed, {stats['bytes']} bytes freed")
+
+        return stats
+
+    def start_collector(self, interval=DEFAULT_GC_INTERVAL, **kwargs):
+        # run collect_files every interval seconds in a daemon thread, kwargs are passed to collect_files
+
+        if self._collector is not None and self._collector.is_alive():
+            return self._collector
+
+        self._collector_stop = threading.Event()
+        kwargs.setdefault('show', False)
+
+        def run():
+            while not self._collector_stop.wait(interval):
+                try:
+                    self.collect_files(**kwargs)
+                except Exception as e:
+                    warnings.warn(f'File cache collector failed : {e}')
+
+        self._collector = threading.Thread(target=run, name=f'filememcache-gc-{self.namespace}', daemon=True)
+        self._collector.start()
+        return self._collector
+
+    def stop_collector(self):
+        if self._collector is None:
+            return
+        self._collector_stop.set()
+        self._collector.join()
+        self._collector = None
+
+    def start_trace(self, func_name):
+        # trace for one cache_it call, NO_TRACE when tracing is off or the call is not sampled
+        if self.tracer is None:
+            return NO_TRACE
+        if self.trace_sample_rate < 1.0 and random.random() >= self.trace_sample_rate:
+            return NO_TRACE
+        return CallTrace(self.tracer, func_name)
+
+    def store_negative(self, key, value, expire):
+        # failures and empty results live in memory only, with a short ttl, and never reach the file cache
+        try:
+            data = pickle.dumps(value)
+            # exceptions with a custom __init__ pickle fine but fail to unpickle, check the round trip
+            pickle.loads(data)
+        except Exception:
+            # not everything raised can be pickled, just don't cache it
+            return
+        self.store(key, data, expire)
+
+    def cache_it(self, expire= None, cache_exceptions=(), exception_expire=DEFAULT_NEGATIVE_EXPIRY,
+                 empty_result=None, empty_expire=DEFAULT_NEGATIVE_EXPIRY):
         """
         This is a decorator factory
         Arguments and function result must be pickleable.
         :param cache: FileMemCache object, if created separately
+        :param cache_exceptions: exception class or tuple of classes to cache, they are re-raised on a hit
+        :param exception_expire: ttl in seconds for cached exceptions
+        :param empty_result: callable(result) returning True for results to cache as empty e.g. is_empty
+        :param empty_expire: ttl in seconds for empty results
         :return: decorated function
         """
 
@@ -631,40 +1269,67 @@ class FileMemCache(object):
             @wraps(function)
             def func(*args, **kwargs):
 
-                signature = inspect.signature(func)
-                bound_arguments = signature.bind(*args, **kwargs)
-                bound_arguments.apply_defaults()
+                trace = self.start_trace(function.__name__)
+                with trace.span('total'):
+                    return cached_call(trace, args, kwargs)
+
+            def cached_call(trace, args, kwargs):
+
+                with trace.span('bind'):
+                    signature = inspect.signature(func)
+                    bound_arguments = signature.bind(*args, **kwargs)
+                    bound_arguments.apply_defaults()
 
                 ## Handle cases where caching is down or otherwise not available.
                 if self.connection is None:
-                    result = function(*args, **kwargs)
+                    with trace.span('call'):
+                        result = function(*args, **kwargs)
                     return result
 
                 ## key will be an hdf5 key in the form of namespace:func_name:hash for parameters:dateDt
                 ## in the form of `function name`:`key`
-                cache_key = self.get_hash( function.__name__, bound_arguments)
+                with trace.span('hash'):
+                    cache_key = self.get_hash( function.__name__, bound_arguments)
 
 
                 try:
-                    return self.get(cache_key,  encoding='iso-8859-1')
+                    value = self.get(cache_key,  encoding='iso-8859-1', trace=trace)
                 except (ExpiredKeyException, CacheMissException) as e:
                     ## Add some sort of cache miss handing here.
                     pass
                 except:
                     raise "Unknown redis-simple-cache error. Please check your Redis free space."
+                else:
+                    if isinstance(value, CachedException):
+                        raise value.exception
+                    if isinstance(value, CachedEmpty):
+                        return value.result
+                    return value
 
 
                 try:
-                    result = function(*args, **kwargs)
+                    with trace.span('call'):
+                        result = function(*args, **kwargs)
                 except DoNotCache as e:
                     result = e.result
+                except cache_exceptions as e:
+                    with trace.span('store_memory'):
+                        self.store_negative(cache_key, CachedException(e), exception_expire)
+                    raise
                 else:
+                    if empty_result is not None and empty_result(result):
+                        with trace.span('store_memory'):
+                            self.store_negative(cache_key, CachedEmpty(result), empty_expire)
+                        return result
+
                     try:
                         # memory cache
-                        self.store_key(cache_key, result, expire)
+                        with trace.span('store_memory'):
+                            self.store_key(cache_key, result, expire)
                         if not self.donotfilecahe:
                             # save it in file cache
-                            self.store_key_file( cache_key, result)
+                            with trace.span('store_file'):
+                                self.store_key_file( cache_key, result)
                     except redis.ConnectionError as e:
                         raise e
 